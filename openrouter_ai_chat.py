@@ -1,32 +1,66 @@
 #!/usr/bin/env python
 
-import requests
+import httpx
+import importlib.util
 import json
 import os
 import socket
 import sys
 
+# 安装了 h2 时启用 HTTP/2（pip install 'httpx[http2]'），否则使用 HTTP/1.1
+# 只检查是否已安装，不在启动时导入
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# 优先使用 orjson 序列化请求和解析流式数据（更快），未安装时退回标准库 json
+try:
+    import orjson as _json
+
+    _loads = _json.loads
+    _dumps = _json.dumps  # orjson 直接返回 UTF-8 bytes
+except ImportError:
+    import json as _json
+
+    _loads = _json.loads
+
+    def _dumps(obj):
+        return _json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def _raw_stdout_fd():
+    """
+    如果 stdout 是 UTF-8 编码且无需换行转换，返回其文件描述符，以便绕过 TextIOWrapper 直接写入；
+    否则返回 None。
+    """
+    try:
+        fd = sys.stdout.fileno()
+    except (AttributeError, ValueError, OSError):
+        return None
+    encoding = (getattr(sys.stdout, "encoding", None) or "").lower()
+    if encoding not in ("utf-8", "utf8") or os.linesep != "\n":
+        return None
+    return fd
+
+
+def _write_fd(fd, data):
+    """将 bytes 完整写入文件描述符（os.write 可能只写入一部分）"""
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
 # Configuration (you can set these in your environment variables)
-# 尝试从环境变量获取 API 密钥
-OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
+def _resolve_key():
+    """
+    获取 OPENROUTER_API_KEY：优先读取环境变量，仅在缺失时才导入 python-dotenv 读取 .env 文件。
+    """
+    # 尝试从环境变量获取 API 密钥
+    api_key = os.environ.get("OPENROUTER_API_KEY")
+    if api_key:
+        return api_key
 
-# Check if API key is configured
-if not OPENROUTER_API_KEY:
     try:
         from dotenv import load_dotenv
-
-        load_dotenv()  # Load environment variables from .env file
-        OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
-        if not OPENROUTER_API_KEY:
-            print(
-                "Error: OPENROUTER_API_KEY not found in environment variables or .env file.",
-                file=sys.stderr,
-            )
-            print(
-                "Please set the OPENROUTER_API_KEY environment variable or create a .env file with OPENROUTER_API_KEY='YOUR_API_KEY'.",
-                file=sys.stderr,
-            )
-            sys.exit(1)
     except ImportError:
         print(
             "Error: python-dotenv library not found. Please install it with 'pip install python-dotenv'",
@@ -38,10 +72,65 @@ if not OPENROUTER_API_KEY:
         )
         sys.exit(1)
 
+    load_dotenv()  # Load environment variables from .env file
+    api_key = os.environ.get("OPENROUTER_API_KEY")
+    if not api_key:
+        print(
+            "Error: OPENROUTER_API_KEY not found in environment variables or .env file.",
+            file=sys.stderr,
+        )
+        print(
+            "Please set the OPENROUTER_API_KEY environment variable or create a .env file with OPENROUTER_API_KEY='YOUR_API_KEY'.",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+    return api_key
+
+
 # Default model for OpenRouter
 # DEFAULT_MODEL = "deepseek/deepseek-chat"  # 这是一个更常用的 DeepSeek 模型别名
 DEFAULT_MODEL = "deepseek/deepseek-r1-0528-qwen3-8b:free"
 
+# 对话历史中最多保留的轮数（每轮包含一条用户消息和一条助手回复），系统消息始终保留
+MAX_TURNS = 20
+
+# SSE 协议中的数据行前缀和流结束标记
+_DATA = b"data: "
+_DATA_LEN = len(_DATA)
+_DONE = b"[DONE]"
+
+# 常见 HTTP 错误状态码对应的提示信息
+_HTTP_ERRORS = {
+    401: "Authentication error (HTTP 401). Please check your API key and try again.",
+    429: "Rate limit exceeded (HTTP 429). Please try again later.",
+}
+
+
+def _handle_http_error(response):
+    """
+    将非 200 响应的错误信息输出到标准错误（仅在出错路径调用）。
+    """
+    status = response.status_code
+    message = _HTTP_ERRORS.get(status)
+    if message:
+        sys.stderr.write(f"\n{message}\n")
+    elif status == 400:
+        try:
+            response.read()  # 流式响应需先读取响应体
+            error_details = response.json()
+            sys.stderr.write(
+                f"\nBad Request (HTTP 400). Details: {error_details.get('message', 'No details provided')}\n"
+            )
+        except json.JSONDecodeError:
+            sys.stderr.write("\nBad Request (HTTP 400). Unable to parse error details.\n")
+    elif status in (500, 502, 503, 504):
+        sys.stderr.write(f"\nServer error (HTTP {status}). Please try again.\n")
+    else:
+        response.read()
+        sys.stderr.write(
+            f"\nUnexpected HTTP error: {status}. Response: {response.text}\n"
+        )
+
 
 class OpenRouterChat:
     def __init__(self, api_key, model=DEFAULT_MODEL):
@@ -53,6 +142,17 @@ class OpenRouterChat:
             # "HTTP-Referer": "http://localhost:8000",  # 可以根据你的实际应用设置
             "X-Title": "My OpenRouter Chat App",  # 可以根据你的实际应用设置
         }
+        # 复用同一个 httpx.Client，多轮对话之间保持 HTTPS 长连接（可用时走 HTTP/2）
+        self.client = httpx.Client(
+            headers=self.headers,
+            timeout=60.0,  # 设置超时时间，防止长时间无响应
+            transport=httpx.HTTPTransport(http2=HTTP2_AVAILABLE, retries=2),
+        )
+        # 流式接收缓冲区和回复片段列表在多轮调用之间复用，避免每次重新分配
+        self._recv_buf = bytearray()
+        self._chunks = []
+        # 上一次流式回复是否正常结束（收到 finish_reason 或 [DONE]）
+        self.last_response_complete = False
         # 维持对话历史
         self.messages = [{"role": "system", "content": "你是一个懂中文的友善的IT专家"}]
 
@@ -77,123 +177,148 @@ class OpenRouterChat:
         """
         内部方法：发送消息到AI并处理流式输出。
         返回完整的AI回复字符串，如果发生错误则返回 None。
+        如果流在中途出错，返回已收到的部分回复，并将 self.last_response_complete 置为 False。
         """
-        payload = {
-            "model": self.model,
-            "messages": messages_history,  # 使用完整的对话历史
-            "stream": True,
-        }
-
+        # 在任何可能出错的步骤之前清空，保证异常处理中取到的是本次的部分回复
+        self._chunks.clear()
+        self.last_response_complete = False
         try:
-            response = requests.post(
-                "https://openrouter.ai/api/v1/chat/completions",
-                headers=self.headers,
-                json=payload,
-                stream=True,  # 必须设置为 True 以接收流式数据
-                timeout=60,  # 设置超时时间，防止长时间无响应
+            # 自行序列化为 bytes，避免 HTTP 客户端内部再用标准库 json 编码一次
+            body = _dumps(
+                {
+                    "model": self.model,
+                    "messages": messages_history,  # 使用完整的对话历史
+                    "stream": True,
+                }
             )
 
-            if response.status_code == 200:
-                full_assistant_response = ""  # 用于存储完整的助手回复
-
-                # print(f"Assistant ({self.model}): ", end='', flush=True) # 交互模式下打印前缀
-
-                for line in response.iter_lines():
-                    if line:
-                        decoded_line = line.decode("utf-8")
-
-                        if decoded_line.startswith("data: "):
-                            json_str = decoded_line[len("data: ") :].strip()
+            with self.client.stream(
+                "POST",
+                "https://openrouter.ai/api/v1/chat/completions",
+                content=body,
+            ) as response:
+                if response.status_code == 200:
+                    chunks = self._chunks  # 用于存储完整的助手回复片段，最后统一拼接
+                    # 循环外缓存属性查找，减少每个 token 的开销
+                    _write = sys.stdout.write
+                    _flush = sys.stdout.flush
+                    _chunks_append = chunks.append
+                    loads = _loads
+                    pending = []  # 本批次尚未写出的输出
+                    _pending_append = pending.append
+
+                    # stdout 为 UTF-8 时直接写文件描述符，跳过 TextIOWrapper 的逐次编码
+                    raw_fd = _raw_stdout_fd()
+                    if raw_fd is not None:
+                        _flush()  # 先写出 TextIOWrapper 中已缓冲的内容（如前缀）
+
+                    def _emit():
+                        text = "".join(pending)
+                        pending.clear()
+                        if raw_fd is not None:
+                            _write_fd(raw_fd, text.encode("utf-8"))
+                        else:
+                            _write(text)
+                            _flush()
+
+                    # print(f"Assistant ({self.model}): ", end='', flush=True) # 交互模式下打印前缀
+
+                    # 手动按行切分 SSE 数据，避免 iter_lines() 逐行解码的开销
+                    buf = self._recv_buf
+                    del buf[:]
+                    # 不指定 chunk_size，每次网络读取到的数据立即交给解析，避免攒满缓冲区才输出
+                    for raw_chunk in response.iter_bytes():
+                        if not raw_chunk:
+                            continue
+                        buf.extend(raw_chunk)
+                        while True:
+                            nl = buf.find(b"\n")
+                            if nl < 0:
+                                break
+                            # 直接在缓冲区上判断前缀，非数据行无需复制
+                            if not buf.startswith(_DATA):
+                                del buf[: nl + 1]
+                                continue
+                            # 只复制一次数据部分，直接交给 JSON 解析，行尾的 \r 等空白无需 strip
+                            json_str = buf[_DATA_LEN:nl]
+                            del buf[: nl + 1]
 
-                            if json_str == "[DONE]":
-                                break  # 流结束
+                            if json_str.startswith(_DONE):
+                                if pending:
+                                    _emit()
+                                self.last_response_complete = True
+                                return "".join(chunks)  # 流结束
 
                             try:
-                                chunk = json.loads(json_str)
+                                chunk = loads(json_str)
 
-                                if "choices" in chunk and len(chunk["choices"]) > 0:
-                                    choice = chunk["choices"][0]
-                                    if (
-                                        "delta" in choice
-                                        and "content" in choice["delta"]
-                                    ):
-                                        content = choice["delta"]["content"]
-                                        sys.stdout.write(content)  # 实时打印
-                                        sys.stdout.flush()
-                                        full_assistant_response += content
-                                    elif (
-                                        "finish_reason" in choice
-                                        and choice["finish_reason"] is not None
-                                    ):
-                                        pass
-                                elif "error" in chunk:
+                                # 流中途出错时 error 会和 finish_reason == "error" 一起出现，需先检查
+                                if "error" in chunk:
+                                    if pending:
+                                        _emit()  # 先把已收到的内容显示出来
                                     error_data = chunk.get("error", {})
                                     sys.stderr.write(
                                         f"\nError from AI: {error_data.get('message', 'Unknown error')}\n"
                                     )
-                                    return None  # 返回None表示出错
+                                    return self._partial_response()  # 保留已收到的部分回复
+                                elif "choices" in chunk and len(chunk["choices"]) > 0:
+                                    choice = chunk["choices"][0]
+                                    # content 可能为 null 或空字符串
+                                    content = choice.get("delta", {}).get("content")
+                                    if content:
+                                        _pending_append(content)  # 实时打印
+                                        _chunks_append(content)
+                                    # finish_reason 可能与最后一段 delta 出现在同一个数据块中
+                                    finish_reason = choice.get("finish_reason")
+                                    if finish_reason is not None and finish_reason != "error":
+                                        self.last_response_complete = True
                             except json.JSONDecodeError as e:
                                 # 忽略无法解析的行
                                 continue
 
-                # print() # 交互模式下换行
-                return full_assistant_response
+                        # 每个网络数据块只 flush 一次，而不是每个 token 一次
+                        if pending:
+                            _emit()
 
-            # 处理非 200 状态码的错误
-            elif response.status_code == 401:
-                sys.stderr.write(
-                    "\nAuthentication error (HTTP 401). Please check your API key and try again.\n"
-                )
-            elif response.status_code == 400:
-                try:
-                    error_details = response.json()
-                    sys.stderr.write(
-                        f"\nBad Request (HTTP 400). Details: {error_details.get('message', 'No details provided')}\n"
-                    )
-                except json.JSONDecodeError:
-                    sys.stderr.write(
-                        "\nBad Request (HTTP 400). Unable to parse error details.\n"
-                    )
-            elif response.status_code == 429:
-                sys.stderr.write(
-                    "\nRate limit exceeded (HTTP 429). Please try again later.\n"
-                )
-            elif response.status_code in [500, 502, 503, 504]:
-                sys.stderr.write(
-                    f"\nServer error (HTTP {response.status_code}). Please try again.\n"
-                )
-            else:
-                sys.stderr.write(
-                    f"\nUnexpected HTTP error: {response.status_code}. Response: {response.text}\n"
-                )
-            return None  # 任何非 200 状态码都返回 None
+                    # print() # 交互模式下换行
+                    return "".join(chunks)
+
+                # 处理非 200 状态码的错误
+                _handle_http_error(response)
+                return None  # 任何非 200 状态码都返回 None
 
-        except requests.exceptions.Timeout:
+        except httpx.TimeoutException:
             sys.stderr.write(
                 "\nNetwork Error: The request timed out. Please check your network connection.\n"
             )
-            return None
-        except requests.exceptions.ConnectionError as e:
+            return self._partial_response()
+        except httpx.TransportError as e:
             sys.stderr.write(
                 f"\nNetwork Error: Could not connect to OpenRouter API. Please check your internet connection. Error: {e}\n"
             )
-            return None
-        except requests.exceptions.RequestException as e:
+            return self._partial_response()
+        except httpx.HTTPError as e:
             sys.stderr.write(f"An unexpected request error occurred: {str(e)}\n")
-            return None
+            return self._partial_response()
         except json.JSONDecodeError as e:
             sys.stderr.write(
                 f"Failed to decode the response JSON (likely malformed data from server): {str(e)}\n"
             )
-            return None
+            return self._partial_response()
         except socket.gaierror as e:
             sys.stderr.write(
                 f"\nNetwork Error: DNS resolution failed for 'api.openrouter.ai'. Please check your network connection and DNS settings. Error: {e}\n"
             )
-            return None
+            return self._partial_response()
         except Exception as e:
             sys.stderr.write(f"An unexpected error occurred: {str(e)}\n")
-            return None
+            return self._partial_response()
+
+    def _partial_response(self):
+        """
+        流式传输中途出错时，返回已收到的部分回复（避免丢弃已计费的内容）；没有内容则返回 None。
+        """
+        return "".join(self._chunks) or None
 
     def interactive_chat(self):
         """
@@ -208,15 +333,19 @@ class OpenRouterChat:
             try:
                 user_message = input(f"You ({self.model}): ")
 
-                if user_message.lower() in ["exit", "quit"]:
+                # 命令都很短，只需对前 6 个字符做一次小写化，避免处理粘贴进来的长文本
+                head = user_message[:6].lower()
+
+                if head in ("exit", "quit"):
                     print("Goodbye!")
+                    self.client.close()
                     break
-                elif user_message.lower().startswith("model "):
+                elif head == "model ":
                     new_model = user_message[6:].strip()
                     self.model = new_model
                     print(f"Switched model to: {self.model}")
                     continue
-                elif user_message.lower().startswith("/file "):
+                elif head == "/file ":
                     file_path = user_message[len("/file "):].strip()
                     if file_path:
                         self._load_file_content(file_path)
@@ -235,6 +364,19 @@ class OpenRouterChat:
                     self.messages.append(
                         {"role": "assistant", "content": ai_response_content}
                     )
+                    if not self.last_response_complete:
+                        # 保留不完整的回复，用户只需发送 "continue" 即可接着生成，无需重发整个问题
+                        print(
+                            "[Response was interrupted. Type 'continue' to let the assistant resume.]",
+                            file=sys.stderr,
+                        )
+                    # 只保留系统消息和最近 MAX_TURNS 轮对话，避免每轮请求体无限增长
+                    if len(self.messages) > 1 + 2 * MAX_TURNS:
+                        # /file 消息没有对应的助手回复，因此在用户消息处截断，保证窗口从用户消息开始
+                        cut = len(self.messages) - 2 * MAX_TURNS
+                        while self.messages[cut]["role"] != "user":
+                            cut += 1
+                        self.messages = self.messages[:1] + self.messages[cut:]
                 else:
                     # 如果没有有效回复，移除用户刚才的输入，避免对话历史不一致
                     if len(self.messages) > 1 and self.messages[-1]["role"] == "user":
@@ -242,6 +384,7 @@ class OpenRouterChat:
 
             except KeyboardInterrupt:
                 print("\nGoodbye!")
+                self.client.close()
                 break
             except Exception as e:
                 # 捕获其他未处理的异常，打印并退出，避免循环崩溃
@@ -249,6 +392,7 @@ class OpenRouterChat:
                     f"\nAn unexpected error occurred in interactive mode: {str(e)}",
                     file=sys.stderr,
                 )
+                self.client.close()
                 break
 
     def handle_piped_input(self, piped_content):
@@ -259,19 +403,28 @@ class OpenRouterChat:
             f"Processing piped input with model: {self.model}\n", file=sys.stderr
         )  # 打印到标准错误，不影响管道输出
 
+        # 管道输入可以是原始 bytes：先在 bytes 上 strip，再一次性解码
+        if isinstance(piped_content, bytes):
+            piped_content = piped_content.strip().decode("utf-8", errors="replace")
+        else:
+            piped_content = piped_content.strip()
+
         # 只包含系统消息和当前管道输入作为用户消息
         temp_messages = self.messages[:1]  # 复制系统消息
         temp_messages.append(
             {"role": "user", "content": "请帮我简要总结以下内容"}
         )  # 添加管道内容
         temp_messages.append(
-            {"role": "user", "content": piped_content.strip()}
+            {"role": "user", "content": piped_content}
         )  # 添加管道内容
 
         # 发送请求，不打印 "Assistant: " 前缀，因为通常希望直接输出AI回复
         ai_response_content = self._send_message_to_ai(temp_messages)
 
-        if ai_response_content:
+        if ai_response_content and not self.last_response_complete:
+            sys.stderr.write("\nWarning: the response was interrupted and is incomplete.\n")
+            sys.exit(1)
+        elif ai_response_content:
             # 在管道模式下，AI的回复直接就是最终输出，不需要再添加到self.messages
             # 因为管道模式通常是一次性操作，不需要多轮对话历史
             pass
@@ -281,25 +434,17 @@ class OpenRouterChat:
 
 
 if __name__ == "__main__":
-    # 再次检查 OPENROUTER_API_KEY，确保它在主执行路径中可用
-    if not OPENROUTER_API_KEY:
-        print(
-            "Please ensure OPENROUTER_API_KEY is set in your environment variables or .env file.",
-            file=sys.stderr,
-        )
-        sys.exit(1)
-
-    chat = OpenRouterChat(OPENROUTER_API_KEY)
+    OPENROUTER_API_KEY = _resolve_key()
 
+    # 先判断运行模式，再构造 OpenRouterChat（及其 HTTP 客户端），空管道输入时无需创建
     # 检查标准输入是否来自管道或重定向文件
     if not sys.stdin.isatty():
-        # 从管道读取所有内容
-        piped_data = sys.stdin.read()
-        if piped_data:
-            chat.handle_piped_input(piped_data)
-        else:
+        # 从管道读取所有内容（直接读取原始 bytes，在 handle_piped_input 中只解码一次）
+        piped_data = sys.stdin.buffer.read()
+        if not piped_data:
             sys.stderr.write("Error: No data piped to stdin.\n")
             sys.exit(1)
+        OpenRouterChat(OPENROUTER_API_KEY).handle_piped_input(piped_data)
     else:
         # 没有管道输入，进入交互式聊天模式
-        chat.interactive_chat()
+        OpenRouterChat(OPENROUTER_API_KEY).interactive_chat()